@@ -0,0 +1,298 @@
+'''
+Persistent on-disk cache of trained models and their scored outputs.
+
+Results are stored under a key hashed from everything that determines them:
+the contents of the training and test data, the variable list, the scaler,
+the model configuration, the fit arguments and the seed. Re-running a notebook
+cell with nothing changed loads the stored weights, decision values and
+sensitivity instead of training again.
+
+In a notebook:
+
+    from masterclass_cache import ResultCache, cached_train
+    cache = ResultCache()
+    model, decision_value, (sens, err) = cached_train(cache, partial(model_nodes_1, 120, variables),
+                                                      df_train, df_test, variables,
+                                                      fit_kwargs={'epochs': 4, 'batch_size': 64})
+
+From the command line:
+
+    python masterclass_cache.py list
+    python masterclass_cache.py purge --older-than 30
+'''
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import time
+
+import numpy as np
+import pandas as pd
+
+from ucl_masterclass import sensitivity_NN, train_fold
+
+
+default_cache_dir = os.path.join(os.path.expanduser('~'), '.cache', 'ucl_masterclass')
+
+
+def dataset_fingerprint(df):
+    '''Hash of the contents (values, columns and index) of a dataframe'''
+    h = hashlib.sha256()
+    h.update(json.dumps([str(c) for c in df.columns]).encode())
+    h.update(pd.util.hash_pandas_object(df, index=True).values.tobytes())
+    return h.hexdigest()
+
+
+def content_fingerprint(value):
+    '''
+    json.dumps default used for cache keys. Dataframes and numpy arrays are
+    replaced by a hash of their contents, other objects raise TypeError rather
+    than being keyed by a repr that is truncated or changes every session.
+    '''
+    if isinstance(value, (pd.DataFrame, pd.Series)):
+        return dataset_fingerprint(value.to_frame() if isinstance(value, pd.Series) else value)
+    if isinstance(value, np.ndarray) and value.dtype != object:
+        h = hashlib.sha256()
+        h.update(json.dumps([str(value.dtype), value.shape]).encode())
+        h.update(np.ascontiguousarray(value).tobytes())
+        return h.hexdigest()
+    if isinstance(value, np.generic):
+        return value.item()
+    raise TypeError(f'Object of type {type(value).__name__} cannot be used in a cache key. '
+                    f'Only json serialisable values, numpy arrays and dataframes are supported.')
+
+
+def strip_names(config):
+    '''
+    Removes auto generated model and layer names (sequential_1, dense_1, ...)
+    from a Keras model config. Other 'name' entries, such as that of the dtype
+    policy, are kept.
+    '''
+    config = {k: v for k, v in config.items() if k != 'name'}
+    # Each entry of 'layers' is a serialised layer, with its own name inside 'config'
+    if isinstance(config.get('config'), dict):
+        config['config'] = strip_names(config['config'])
+    if isinstance(config.get('layers'), list):
+        config['layers'] = [strip_names(layer) if isinstance(layer, dict) else layer for layer in config['layers']]
+    return config
+
+
+def model_fingerprint(model):
+    '''
+    Configuration of a Keras model without layer names, with the configuration
+    of its optimizer (including its name, e.g. Nadam or Adamax) and the loss
+    and metrics it was compiled with.
+    '''
+    config = {'model': strip_names(model.get_config())}
+    optimizer = getattr(model, 'optimizer', None)
+    if optimizer is not None and hasattr(optimizer, 'get_config'):
+        config['optimizer'] = optimizer.get_config()
+    if hasattr(model, 'get_compile_config'):
+        config['compile'] = model.get_compile_config()
+    else:
+        # Older Keras without get_compile_config, only the loss is available
+        loss = getattr(model, 'loss', None)
+        config['compile'] = {'loss': getattr(loss, '__name__', loss)}
+    return config
+
+
+class ResultCache:
+    '''
+    Directory of cached results, one subdirectory per key holding meta.json,
+    weights.npz and decision_value.npy. When the total size goes above
+    max_bytes the least recently used entries are removed.
+
+    Parameters:
+        path - cache directory
+        max_bytes - size limit of the cache in bytes
+    '''
+
+    def __init__(self, path=default_cache_dir, max_bytes=2*1024**3):
+        self.path = path
+        self.max_bytes = max_bytes
+        os.makedirs(path, exist_ok=True)
+
+    def key(self, **parts):
+        '''
+        Hash of the given parts. Dataframes and numpy arrays are hashed by their
+        contents, everything else must be serialisable to json.
+        '''
+        return hashlib.sha256(json.dumps(parts, sort_keys=True, default=content_fingerprint).encode()).hexdigest()[:32]
+
+    def entries(self):
+        '''Returns a list of the meta dicts of all entries, least recently used first'''
+        entries = []
+        for key in os.listdir(self.path):
+            meta_path = os.path.join(self.path, key, 'meta.json')
+            if os.path.exists(meta_path):
+                with open(meta_path) as f:
+                    entries.append(json.load(f))
+        return sorted(entries, key=lambda e: e['last_access'])
+
+    def get(self, key):
+        '''
+        Returns the cached entry for key, or None. The entry is a dict with
+        'weights' (list of numpy arrays), 'decision_value' (memory mapped numpy
+        array), 'sensitivity' and 'meta'.
+        '''
+        entry_dir = os.path.join(self.path, key)
+        meta_path = os.path.join(entry_dir, 'meta.json')
+        if not os.path.exists(meta_path):
+            return None
+
+        with open(meta_path) as f:
+            meta = json.load(f)
+        meta['last_access'] = time.time()
+        with open(meta_path, 'w') as f:
+            json.dump(meta, f)
+
+        weights = None
+        if os.path.exists(os.path.join(entry_dir, 'weights.npz')):
+            with np.load(os.path.join(entry_dir, 'weights.npz')) as w:
+                weights = [w[f'arr_{i}'] for i in range(len(w.files))]
+        decision_value = None
+        if os.path.exists(os.path.join(entry_dir, 'decision_value.npy')):
+            decision_value = np.load(os.path.join(entry_dir, 'decision_value.npy'), mmap_mode='r')
+
+        return {'weights': weights, 'decision_value': decision_value,
+                'sensitivity': meta['sensitivity'], 'meta': meta}
+
+    def put(self, key, weights=None, decision_value=None, sensitivity=None, description=''):
+        '''
+        Stores a result under key. The entry is written to a temporary directory
+        and renamed into place, so an interrupted write never leaves a partial entry.
+
+        Parameters:
+            key - string returned by ResultCache.key
+            weights - list of numpy arrays, e.g. model.get_weights()
+            decision_value - numpy array of scored outputs
+            sensitivity - json serialisable sensitivity, e.g. the (sens, error) tuple
+            description - string shown by the command line listing
+        '''
+        entry_dir = os.path.join(self.path, key)
+        tmp_dir = os.path.join(self.path, f'.tmp-{key}-{os.getpid()}')
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        os.makedirs(tmp_dir)
+
+        if weights is not None:
+            np.savez(os.path.join(tmp_dir, 'weights.npz'), *weights)
+        if decision_value is not None:
+            np.save(os.path.join(tmp_dir, 'decision_value.npy'), np.asarray(decision_value))
+
+        size = sum(os.path.getsize(os.path.join(tmp_dir, f)) for f in os.listdir(tmp_dir))
+        now = time.time()
+        meta = {'key': key, 'description': description, 'sensitivity': sensitivity,
+                'created': now, 'last_access': now, 'size': size}
+        with open(os.path.join(tmp_dir, 'meta.json'), 'w') as f:
+            json.dump(meta, f)
+
+        shutil.rmtree(entry_dir, ignore_errors=True)
+        os.rename(tmp_dir, entry_dir)
+        self.evict()
+
+    def evict(self):
+        '''Removes least recently used entries until the cache fits in max_bytes'''
+        entries = self.entries()
+        total = sum(e['size'] for e in entries)
+        for e in entries:
+            if total <= self.max_bytes:
+                break
+            self.remove(e['key'])
+            total -= e['size']
+
+    def remove(self, key):
+        shutil.rmtree(os.path.join(self.path, key), ignore_errors=True)
+
+    def purge(self, older_than=None):
+        '''
+        Removes all entries, or only those not used for older_than days.
+
+        Returns:
+            removed - number of entries removed
+        '''
+        removed = 0
+        for e in self.entries():
+            if older_than is None or time.time() - e['last_access'] > older_than*86400:
+                self.remove(e['key'])
+                removed += 1
+        return removed
+
+
+def cached_train(cache, build_model, df_train, df_test, variables, scaler='standard', fit_kwargs=None, seed=0,
+                 model_config=None, description=''):
+    '''
+    Trains a model and scores df_test, or loads the result from the cache if the
+    same configuration was trained before.
+
+    Parameters:
+        cache - ResultCache
+        build_model - function taking no arguments and returning a compiled model
+        df_train - pandas dataframe containing training data
+        df_test - pandas dataframe containing test data
+        variables - list of strings of variables to be used for training
+        scaler - scaling mode passed to scale_prepare_data
+        fit_kwargs - dict of keyword arguments for model.fit. Values must be json serialisable,
+            numpy arrays (e.g. validation_data=dset_val) or dataframes, other objects such
+            as callbacks raise TypeError
+        seed - integer random seed
+        model_config - json serialisable description of the model used in the key.
+            Defaults to the Keras config of the model returned by build_model
+        description - string shown by the command line listing
+
+    Returns:
+        model - trained model
+        decision_value - numpy array of scores of df_test (memory mapped if loaded from the cache)
+        (sens, error) - sensitivity_NN of df_test
+    '''
+    model = build_model()
+    if model_config is None:
+        model_config = model_fingerprint(model)
+
+    columns = list(variables) + ['Class', 'training_weight']
+    # The test weights also enter the sensitivity
+    test_columns = columns + ['EventWeight', 'post_fit_weight']
+    key = cache.key(train=df_train[columns], test=df_test[test_columns], variables=list(variables), scaler=scaler,
+                    model=model_config, fit_kwargs=fit_kwargs, seed=seed)
+
+    entry = cache.get(key)
+    if entry is not None:
+        model.set_weights(entry['weights'])
+        return model, entry['decision_value'], tuple(entry['sensitivity'])
+
+    decision_value, model = train_fold(build_model, df_train, df_test, variables, scaler, fit_kwargs, seed,
+                                       return_model=True)
+
+    df_scored = df_test[['Class', 'EventWeight', 'post_fit_weight']].copy()
+    df_scored['decision_value'] = decision_value
+    sensitivity = sensitivity_NN(df_scored)
+
+    cache.put(key, model.get_weights(), decision_value, list(sensitivity), description)
+
+    return model, decision_value, sensitivity
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Inspect or purge the masterclass result cache')
+    parser.add_argument('--dir', default=default_cache_dir, help='cache directory')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    subparsers.add_parser('list', help='list cached entries, least recently used first')
+    purge_parser = subparsers.add_parser('purge', help='remove cached entries')
+    purge_parser.add_argument('keys', nargs='*', help='keys to remove. Removes all entries if none are given')
+    purge_parser.add_argument('--older-than', type=float, default=None,
+                              help='only remove entries not used for this many days')
+    args = parser.parse_args()
+
+    cache = ResultCache(args.dir, max_bytes=np.inf)
+    if args.command == 'list':
+        entries = cache.entries()
+        for e in entries:
+            last = time.strftime('%Y-%m-%d %H:%M', time.localtime(e['last_access']))
+            print(f"{e['key']}  {e['size']/1024**2:8.2f} MB  {last}  {e['sensitivity']}  {e['description']}")
+        print(f"{len(entries)} entries, {sum(e['size'] for e in entries)/1024**2:.2f} MB in {args.dir}")
+    elif args.keys:
+        for key in args.keys:
+            cache.remove(key)
+        print(f'Removed {len(args.keys)} entries')
+    else:
+        print(f'Removed {cache.purge(args.older_than)} entries')
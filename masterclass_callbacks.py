@@ -0,0 +1,96 @@
+'''
+Keras callbacks for training the masterclass networks.
+
+Kept apart from ucl_masterclass so that importing the analysis functions, as
+the Cut-Based notebook and masterclass_service do, does not load keras and
+TensorFlow.
+'''
+import time
+
+import numpy as np
+from keras.callbacks import Callback
+
+from ucl_masterclass import sensitivity_NN_arrays
+
+
+class SensitivityCallback(Callback):
+    '''
+    Keras callback computing the sensitivity on the validation set at the end of
+    each epoch. The value is added to the logs as 'val_sensitivity' (and
+    'val_sensitivity_error'), so it appears in the history returned by
+    model.fit and is plotted by plot_histories. It can also stop training when
+    the sensitivity stops improving, and optionally restore the weights of the
+    best epoch.
+
+    The scaled validation inputs and the event weights are cached once, scores
+    are written into a preallocated buffer and the sensitivity uses
+    sensitivity_NN_arrays, so the overhead per epoch is small.
+
+    Parameters:
+        x_val - numpy array of scaled validation data, e.g. dset_val[0]
+        df_val - pandas dataframe of the validation events, with 'Class',
+            'EventWeight' and 'post_fit_weight'
+        patience - stop after this many epochs without improvement. None never stops
+        min_delta - minimum increase in sensitivity to count as an improvement
+        restore_best_weights - set the model weights to the best epoch at the end of training.
+            False (the default, as for keras EarlyStopping) keeps the weights of the last epoch
+        batch_size - number of events scored per model call
+
+    Example:
+        from masterclass_callbacks import SensitivityCallback
+        sens_cb = SensitivityCallback(dset_val[0], df_val, patience=5)
+        history = model.fit(x_train, y_train, sample_weight=w_train, epochs=50,
+                            validation_data=dset_val, callbacks=[sens_cb])
+        plot_histories(history)
+    '''
+
+    def __init__(self, x_val, df_val, patience=None, min_delta=0, restore_best_weights=False, batch_size=8192):
+        super().__init__()
+        self.x_val = np.ascontiguousarray(x_val, dtype=np.float32)
+        self.classes = df_val['Class'].values
+        self.event_weights = df_val['EventWeight'].values
+        self.post_fit_weights = df_val['post_fit_weight'].values
+        self.score = np.empty(len(self.x_val))
+        self.patience = patience
+        self.min_delta = min_delta
+        self.restore_best_weights = restore_best_weights
+        self.batch_size = batch_size
+
+    def on_train_begin(self, logs=None):
+        self.sensitivities = []
+        self.times = []
+        self.best = -np.inf
+        self.best_epoch = None
+        self.best_weights = None
+        self.wait = 0
+
+    def on_epoch_end(self, epoch, logs=None):
+        start = time.time()
+
+        # Score directly into the buffer, avoiding the overhead of model.predict
+        for i in range(0, len(self.x_val), self.batch_size):
+            batch = self.model(self.x_val[i:i+self.batch_size], training=False)
+            self.score[i:i+self.batch_size] = np.asarray(batch).reshape(-1)
+
+        sens, error = sensitivity_NN_arrays(self.score, self.classes, self.event_weights, self.post_fit_weights)
+        self.sensitivities.append(sens)
+        if logs is not None:
+            logs['val_sensitivity'] = sens
+            logs['val_sensitivity_error'] = error
+
+        if sens > self.best + self.min_delta:
+            self.best = sens
+            self.best_epoch = epoch
+            self.wait = 0
+            if self.restore_best_weights:
+                self.best_weights = self.model.get_weights()
+        else:
+            self.wait += 1
+            if self.patience is not None and self.wait >= self.patience:
+                self.model.stop_training = True
+
+        self.times.append(time.time() - start)
+
+    def on_train_end(self, logs=None):
+        if self.restore_best_weights and self.best_weights is not None:
+            self.model.set_weights(self.best_weights)
@@ -0,0 +1,219 @@
+'''
+Binned profile likelihood fit of the signal strength with background
+normalisation uncertainties.
+
+The sensitivity functions in ucl_masterclass use the per-bin Asimov formula
+without nuisance parameters. Here the expected yield in bin i is
+
+    nu_i = mu * s_i + sum_p b_pi * kappa_p ** theta_p
+
+with one log-normal normalisation parameter theta_p per background process
+(kappa_p = 1 + relative uncertainty) and a unit Gaussian constraint on each
+theta_p. The likelihood, its gradient and Hessian are evaluated with array
+operations over all bins and processes, and minimised with a damped Newton
+method. Everything is batched, so many toy or Asimov datasets are fitted at once.
+
+    from masterclass_fit import BinnedLikelihood
+    likelihood = BinnedLikelihood.from_dataframe(df, norm_uncertainties={'ttbar': 0.1, 'W+(bb,bc,cc,bl)': 0.2})
+    likelihood.discovery_significance()                        # Asimov dataset
+    likelihood.discovery_significance(likelihood.toys(1000))   # toys
+
+Without uncertainties the Asimov significance equals sensitivity_cut_based.
+'''
+import numpy as np
+
+from ucl_masterclass import class_names_grouped, cut_based_bins, process_histograms
+
+
+class BinnedLikelihood:
+    '''
+    Parameters:
+        signal - numpy array of expected signal per bin
+        backgrounds - numpy array of shape (n_processes, n_bins), expected background per process
+        norm_uncertainties - relative normalisation uncertainty of each background process.
+            Processes with 0 are still given a parameter, it stays at 0 in the fit.
+        names - optional list of background process names
+    '''
+
+    def __init__(self, signal, backgrounds, norm_uncertainties=None, names=None):
+        signal = np.asarray(signal, dtype=float)
+        backgrounds = np.atleast_2d(np.asarray(backgrounds, dtype=float))
+        if norm_uncertainties is None:
+            norm_uncertainties = np.zeros(len(backgrounds))
+
+        # Bins with nothing expected do not contribute to the likelihood. They are
+        # dropped internally, data and toys keep the binning of the histograms
+        self.filled = (signal + backgrounds.sum(axis=0)) != 0
+        self.signal = signal[self.filled]
+        self.backgrounds = backgrounds[:, self.filled]
+        self.log_kappa = np.log1p(np.asarray(norm_uncertainties, dtype=float))
+        self.names = names
+        self.n_params = 1 + len(self.backgrounds)
+
+    @classmethod
+    def from_histograms(cls, counts, norm_uncertainties=None):
+        '''
+        Builds the likelihood from the output of process_histograms.
+
+        Parameters:
+            counts - numpy array of shape (len(class_names_grouped), n_bins)
+            norm_uncertainties - dict of background process name in class_names_grouped[1:] to relative
+                normalisation uncertainty. Processes not given have none.
+        '''
+        norm_uncertainties = norm_uncertainties or {}
+        names = class_names_grouped[1:]
+        for t in norm_uncertainties:
+            if t not in names:
+                raise ValueError(f'Background process {t} not recognised. Only {names} are supported.')
+        return cls(counts[0], counts[1:], [norm_uncertainties.get(t, 0) for t in names], names)
+
+    @classmethod
+    def from_dataframe(cls, df, norm_uncertainties=None, variable='mBB', bins=cut_based_bins, weight='EventWeight'):
+        '''Builds the likelihood from the per-process histograms of a dataframe'''
+        counts, bins = process_histograms(df, variable, bins, weight)
+        return cls.from_histograms(counts, norm_uncertainties)
+
+    def initial_params(self, n, mu=1.0):
+        params = np.zeros((n, self.n_params))
+        params[:, 0] = mu
+        return params
+
+    def expected(self, params):
+        '''
+        Expected yields for each set of parameters.
+
+        Parameters:
+            params - numpy array of shape (n, n_params), columns are mu then the thetas
+
+        Returns:
+            nu - numpy array of shape (n, n_bins), only the bins where something is expected
+            norm - numpy array of shape (n, n_processes), the background scale factors
+        '''
+        norm = np.exp(params[:, 1:] * self.log_kappa)
+        return params[:, :1] * self.signal + norm @ self.backgrounds, norm
+
+    def nll(self, params, data):
+        '''Negative log likelihood (up to a constant) of each dataset, shape (n,)'''
+        nu, _ = self.expected(params)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            log_term = np.where(data > 0, data * np.log(nu), 0)
+        return (nu - log_term).sum(axis=1) + 0.5 * (params[:, 1:] ** 2).sum(axis=1)
+
+    def grad_hess(self, params, data):
+        '''
+        Analytic gradient and a positive definite approximation of the Hessian of nll.
+
+        Returns:
+            grad - numpy array of shape (n, n_params)
+            hess - numpy array of shape (n, n_params, n_params)
+        '''
+        nu, norm = self.expected(params)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            ratio = np.where(nu > 0, data / nu, 0)
+            q = np.where(nu > 0, ratio / nu, 0)
+        r = 1 - ratio
+
+        # Derivatives of nu with respect to each parameter, shape (n, n_params, n_bins)
+        jac = np.empty((len(params), self.n_params, len(self.signal)))
+        jac[:, 0] = self.signal
+        jac[:, 1:] = norm[:, :, None] * (self.backgrounds * self.log_kappa[:, None])
+
+        grad = np.einsum('nkb,nb->nk', jac, r)
+        grad[:, 1:] += params[:, 1:]
+
+        hess = (jac * q[:, None, :]) @ jac.transpose(0, 2, 1)
+        # Second derivative of nu wrt theta, clipped at 0 to keep the step a descent direction
+        curvature = np.einsum('npb,nb->np', jac[:, 1:], r) * self.log_kappa
+        diag = np.arange(1, self.n_params)
+        hess[:, diag, diag] += np.maximum(curvature, 0) + 1
+
+        return grad, hess
+
+    def fit(self, data, mu=None, max_iter=100, tol=1e-9):
+        '''
+        Minimises nll for each dataset.
+
+        Parameters:
+            data - numpy array of shape (n_bins,) or (n, n_bins) of observed counts, with
+                the binning of the histograms the likelihood was built from
+            mu - fix the signal strength to this value, or None to fit it
+            max_iter - maximum number of Newton iterations
+            tol - stop when no parameter moves by more than this
+
+        Returns:
+            params - numpy array of shape (n, n_params) at the minimum, mu first
+            nll - numpy array of shape (n,), the minimum nll
+        '''
+        data = np.atleast_2d(np.asarray(data, dtype=float))[:, self.filled]
+        params = self.initial_params(len(data), 1.0 if mu is None else mu)
+        nll = self.nll(params, data)
+        eye = np.eye(self.n_params)
+        # Datasets still being minimised
+        active = np.arange(len(data))
+
+        for _ in range(max_iter):
+            grad, hess = self.grad_hess(params[active], data[active])
+            if mu is not None:
+                grad[:, 0] = 0
+                hess[:, 0, :] = 0
+                hess[:, :, 0] = 0
+                hess[:, 0, 0] = 1
+            step = -np.linalg.solve(hess + 1e-12 * eye, grad[:, :, None])[:, :, 0]
+
+            # Backtracking line search, done for all active datasets together
+            alpha = np.ones(len(active))
+            todo = np.abs(step).max(axis=1) >= tol
+            for _ in range(40):
+                if not todo.any():
+                    break
+                trial = params[active[todo]] + alpha[todo, None] * step[todo]
+                nu, _ = self.expected(trial)
+                valid = np.all((nu > 0) | ((nu == 0) & (data[active[todo]] == 0)), axis=1)
+                trial_nll = np.where(valid, self.nll(trial, data[active[todo]]), np.inf)
+                accept = trial_nll <= nll[active[todo]]
+
+                idx = np.flatnonzero(todo)[accept]
+                params[active[idx]] = trial[accept]
+                nll[active[idx]] = trial_nll[accept]
+                todo[idx] = False
+                alpha[todo] /= 2
+
+            # Datasets where no step was taken, or a negligible one, have converged
+            moved = np.where(todo, 0, alpha) * np.abs(step).max(axis=1)
+            active = active[moved >= tol]
+            if not len(active):
+                break
+
+        return params, nll
+
+    def asimov(self, mu=1.0):
+        '''Asimov dataset: the expected yields at mu with nominal backgrounds, shape (n_bins,)'''
+        asimov = np.zeros(len(self.filled))
+        asimov[self.filled] = self.expected(self.initial_params(1, mu))[0][0]
+        return asimov
+
+    def toys(self, n, mu=1.0, seed=None):
+        '''Poisson fluctuated datasets around the expected yields at mu, shape (n, n_bins)'''
+        rng = np.random.default_rng(seed)
+        return rng.poisson(self.asimov(mu), size=(n, len(self.filled))).astype(float)
+
+    def discovery_significance(self, data=None):
+        '''
+        Significance of rejecting the background only hypothesis (mu = 0), from
+        the profile likelihood ratio q0 = 2*(nll(mu=0) - nll(best fit)).
+
+        Parameters:
+            data - observed counts, shape (n_bins,) or (n, n_bins). Defaults to the Asimov dataset
+
+        Returns:
+            Z - float for a single dataset, numpy array of shape (n,) otherwise
+        '''
+        single = data is None or np.ndim(data) == 1
+        data = self.asimov() if data is None else data
+
+        params, nll_free = self.fit(data)
+        _, nll_bkg = self.fit(data, mu=0.0)
+        q0 = np.where(params[:, 0] > 0, 2 * (nll_bkg - nll_free), 0)
+        Z = np.sqrt(np.maximum(q0, 0))
+
+        return float(Z[0]) if single else Z
@@ -0,0 +1,245 @@
+'''
+Local compute service for masterclass sessions.
+
+Rather than every student loading VHbb_data_2jet.csv into their own kernel, one
+server process loads the dataset once and answers sensitivity, cut scan and
+histogram requests over a Unix socket (or localhost TCP). Identical requests
+arriving at the same time are computed once and shared, and results are kept
+in an LRU cache.
+
+Start the server once on the shared machine:
+
+    python masterclass_service.py ../data-v2/VHbb_data_2jet.csv
+
+and in each notebook use the client in place of the dataframe functions:
+
+    from masterclass_service import MasterclassClient
+    client = MasterclassClient()
+    client.sensitivity_cut_based(cuts=[('Mtop', '>', 100000)])
+    client.sensitivity_cut_scan('pTB2', np.arange(0, 60001, 1000))
+
+Requests and responses are single lines of JSON.
+'''
+import argparse
+import asyncio
+import json
+import operator
+import os
+import socket
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+
+from ucl_masterclass import (class_names_grouped, class_names_map, asimov_sensitivity,
+                             sensitivity_cut_based, threshold_counts)
+
+
+default_socket = '/tmp/ucl_masterclass.sock'
+
+cut_operators = {'>': operator.gt,
+    '>=': operator.ge,
+    '<': operator.lt,
+    '<=': operator.le,
+    '==': operator.eq,
+    '!=': operator.ne
+}
+
+
+def numpy_scalar(value):
+    '''json.dumps default converting numpy scalars, e.g. cut values taken from np.arange, to Python numbers'''
+    if isinstance(value, np.generic):
+        return value.item()
+    raise TypeError(f'Object of type {type(value).__name__} is not JSON serializable')
+
+
+class MasterclassServer:
+    '''
+    Holds a single copy of the dataset as numpy columns and serves requests on it.
+
+    Parameters:
+        df - pandas dataframe of events, as read from VHbb_data_2jet.csv
+        cache_size - maximum number of results kept in the LRU cache
+    '''
+
+    def __init__(self, df, cache_size=256):
+        # Keep only numpy columns, the dataframe itself is not needed after this
+        self.columns = {c: df[c].values for c in df.columns if c != 'sample'}
+        self.group = np.full(len(df), -1, dtype=np.int8)
+        for i, t in enumerate(class_names_grouped):
+            self.group[df['sample'].isin(class_names_map[t]).values] = i
+
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+        self.inflight = {}
+        self.handlers = {'sensitivity_cut_based': self.sensitivity_cut_based,
+                         'sensitivity_cut_scan': self.sensitivity_cut_scan,
+                         'histogram': self.histogram,
+                         'info': self.info}
+
+    def selection(self, cuts):
+        '''Boolean mask of events passing a list of (variable, op, value) cuts'''
+        mask = np.ones(len(self.group), dtype=bool)
+        for variable, op, value in cuts or []:
+            if op not in cut_operators:
+                raise ValueError(f'Cut operator {op} not recognised. Only {list(cut_operators)} are supported.')
+            mask &= cut_operators[op](self.columns[variable], value)
+        return mask
+
+    def sensitivity_cut_based(self, cuts=None):
+        mask = self.selection(cuts)
+        return sensitivity_cut_based(pd.DataFrame({c: self.columns[c][mask] for c in ('Class', 'mBB', 'EventWeight')}))
+
+    def sensitivity_cut_scan(self, variable, thresholds, direction='>', cuts=None):
+        mask = self.selection(cuts)
+        thresholds = np.asarray(thresholds, dtype=float)
+        order = np.argsort(thresholds, kind='stable')
+        s_counts, b_counts = threshold_counts(self.columns[variable][mask], self.columns['mBB'][mask],
+                                              self.columns['Class'][mask], self.columns['EventWeight'][mask],
+                                              thresholds[order], direction)
+        sensitivities = np.empty(len(thresholds))
+        sensitivities[order] = asimov_sensitivity(s_counts, b_counts)
+        return sensitivities.tolist()
+
+    def histogram(self, variable, bins=20, cuts=None, weight='post_fit_weight'):
+        mask = self.selection(cuts)
+        values = self.columns[variable][mask]
+        weights = self.columns[weight][mask]
+        group = self.group[mask]
+        # Common edges for all processes, as plt.hist does for stacked data
+        edges = np.histogram_bin_edges(values, bins=bins)
+        counts = {t: np.histogram(values[group == i], bins=edges, weights=weights[group == i])[0].tolist()
+                  for i, t in enumerate(class_names_grouped)}
+        return {'bins': edges.tolist(), 'counts': counts}
+
+    def info(self):
+        return {'n_events': len(self.group), 'columns': sorted(self.columns) + ['sample'],
+                'cached': len(self.cache), 'cache_size': self.cache_size}
+
+    async def request(self, op, args):
+        '''Returns the result of a request, sharing work between identical requests'''
+        if op not in self.handlers:
+            raise ValueError(f'Request {op} not recognised.')
+        if op == 'info':
+            return self.info()
+
+        key = json.dumps([op, args], sort_keys=True)
+        if key in self.cache:
+            self.cache.move_to_end(key)
+            return self.cache[key]
+        if key in self.inflight:
+            return await asyncio.shield(self.inflight[key])
+
+        future = asyncio.get_running_loop().run_in_executor(None, lambda: self.handlers[op](**args))
+        self.inflight[key] = future
+        try:
+            result = await future
+        finally:
+            del self.inflight[key]
+
+        self.cache[key] = result
+        if len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+        return result
+
+    async def handle(self, reader, writer):
+        while True:
+            line = await reader.readline()
+            if not line:
+                break
+            try:
+                message = json.loads(line)
+                reply = {'result': await self.request(message['op'], message.get('args', {}))}
+            except Exception as e:
+                reply = {'error': f'{type(e).__name__}: {e}'}
+            writer.write(json.dumps(reply).encode() + b'\n')
+            await writer.drain()
+        writer.close()
+
+    async def serve(self, path=default_socket, host=None, port=None, mode=0o666):
+        '''
+        Serves requests until cancelled, on the Unix socket path, or over TCP if port is given.
+        mode is the permission of the socket, by default any user on the machine can connect.
+        '''
+        if port is not None:
+            server = await asyncio.start_server(self.handle, host or '127.0.0.1', port, limit=2**24)
+        else:
+            server = await asyncio.start_unix_server(self.handle, path, limit=2**24)
+            # The socket is created with the server's umask, which stops other accounts connecting
+            os.chmod(path, mode)
+        async with server:
+            await server.serve_forever()
+
+
+class MasterclassClient:
+    '''
+    Thin client for MasterclassServer. Methods mirror the ucl_masterclass
+    functions, but take a list of cuts, e.g. [('Mtop', '>', 100000), ('pTV', '<', 300000)],
+    instead of a filtered dataframe.
+
+    Parameters:
+        path - Unix socket of the server
+        host, port - connect over TCP instead, if port is given
+    '''
+
+    def __init__(self, path=default_socket, host=None, port=None):
+        if port is not None:
+            self.sock = socket.create_connection((host or '127.0.0.1', port))
+        else:
+            self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.sock.connect(path)
+        self.stream = self.sock.makefile('rwb')
+
+    def request(self, op, **args):
+        self.stream.write(json.dumps({'op': op, 'args': args}, default=numpy_scalar).encode() + b'\n')
+        self.stream.flush()
+        reply = json.loads(self.stream.readline())
+        if 'error' in reply:
+            raise RuntimeError(reply['error'])
+        return reply['result']
+
+    def sensitivity_cut_based(self, cuts=None):
+        '''Sensitivity of the events passing cuts, see ucl_masterclass.sensitivity_cut_based'''
+        return self.request('sensitivity_cut_based', cuts=cuts)
+
+    def sensitivity_cut_scan(self, variable, thresholds, direction='>', cuts=None):
+        '''Sensitivity for each threshold, see ucl_masterclass.sensitivity_cut_scan'''
+        return np.array(self.request('sensitivity_cut_scan', variable=variable,
+                                     thresholds=[float(t) for t in thresholds],
+                                     direction=direction, cuts=cuts))
+
+    def histogram(self, variable, bins=20, cuts=None, weight='post_fit_weight'):
+        '''
+        Per-process histograms of variable, as stacked by plot_variable.
+
+        Returns:
+            bins - numpy array of bin edges
+            counts - dict of process name to numpy array of weighted counts
+        '''
+        if not np.isscalar(bins):
+            bins = [float(b) for b in bins]
+        result = self.request('histogram', variable=variable, bins=bins, cuts=cuts, weight=weight)
+        return np.array(result['bins']), {t: np.array(c) for t, c in result['counts'].items()}
+
+    def info(self):
+        return self.request('info')
+
+    def close(self):
+        self.stream.close()
+        self.sock.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Serve masterclass sensitivity requests from a shared dataset')
+    parser.add_argument('data', help='csv file of events, e.g. ../data-v2/VHbb_data_2jet.csv')
+    parser.add_argument('--socket', default=default_socket, help='Unix socket path')
+    parser.add_argument('--host', default=None, help='serve over TCP on this host (with --port)')
+    parser.add_argument('--port', type=int, default=None, help='serve over TCP on this port')
+    parser.add_argument('--mode', type=lambda m: int(m, 8), default=0o666,
+                        help='octal permissions of the Unix socket, e.g. 660 to limit it to a group')
+    parser.add_argument('--cache-size', type=int, default=256, help='number of results to cache')
+    args = parser.parse_args()
+
+    server = MasterclassServer(pd.read_csv(args.data), cache_size=args.cache_size)
+    print(f'Loaded {len(server.group)} events')
+    asyncio.run(server.serve(args.socket, args.host, args.port, args.mode))
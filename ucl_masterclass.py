@@ -1,4 +1,5 @@
 import numpy as np
+import pandas as pd
 import time
 from copy import deepcopy
 import math
@@ -10,6 +11,8 @@ from matplotlib.text import OffsetFrom
 from matplotlib.lines import Line2D
 
 from sklearn import preprocessing
+from sklearn.model_selection import StratifiedKFold
+from joblib import Parallel, delayed
 
 
 ##########################
@@ -503,48 +506,601 @@ def plot_variable(df,variable, bins = None,bin_number = 20):
     plt.show()
 
 
-def sensitivity_cut_based(df):
-    """Calculate sensitivity from dataframe with error"""
+#Accumulation modes for weighted sums, see weighted_bincount
+precision_modes = ['float64', 'float32', 'pairwise', 'kahan']
+default_precision = 'float64'
 
-    # Initialise sensitivity and error.
-    sens_sq = 0
-    bins = np.arange(20*1e3,260*1e3,20*1e3)
-    #Split into signal and background events
-    classes = df['Class']
-    dec_vals = df['mBB']
-    weights = df['EventWeight']
 
-    y_data = zip(classes, dec_vals, weights)
+def weighted_bincount(cell, weights, minlength, precision=None, power=1):
+    '''
+    Sum of weights (or weights**power) in each cell, with a selectable accumulation
+    precision. Weights can be stored as float32 to halve memory, while the sums
+    are accumulated safely:
+        'float64' - accumulate in float64 (np.bincount). The default
+        'float32' - plain float32 accumulation, only for comparison, it loses
+            precision when adding small weights to large sums
+        'pairwise' - float32 pairwise summation of each cell (np.sum), error grows
+            as log(n) rather than n. Loops over the filled cells
+        'kahan' - float32 Kahan compensated summation, vectorised across cells.
+            Loops over about sqrt of the largest number of events in a cell
 
-    events_sb = [[a[1] for a in deepcopy(y_data) if a[0] == 1], [a[1] for a in deepcopy(y_data) if a[0] == 0]]
-    weights_sb = [[a[2] for a in deepcopy(y_data) if a[0] == 1], [a[2] for a in deepcopy(y_data) if a[0] == 0]]
+    Parameters:
+        cell - numpy array of integer cell index of each event
+        weights - numpy array of event weights
+        minlength - number of cells
+        precision - one of precision_modes, defaults to default_precision
+        power - sum weights**power, e.g. 2 for the sum of weights squared
 
-    #plots histogram with optimised bins and counts number of signal and background events in each bin
-    plt.ioff()
-    counts_sb = plt.hist(events_sb,
-                         bins=bins,
-                         weights=weights_sb)[0]
-    plt.close()
-    plt.ion()
+    Returns:
+        sums - float64 numpy array of length minlength
+    '''
+    precision = precision or default_precision
+    if precision == 'float64':
+        return np.bincount(cell, weights=np.asarray(weights, dtype=np.float64)**power, minlength=minlength)
+
+    weights = np.asarray(weights, dtype=np.float32)**power
+    if precision == 'float32':
+        sums = np.zeros(minlength, dtype=np.float32)
+        np.add.at(sums, cell, weights)
+        return sums.astype(np.float64)
+
+    # Group the events of each cell together
+    order = np.argsort(cell, kind='stable')
+    cell = cell[order]
+    weights = weights[order]
+    starts = np.flatnonzero(np.r_[True, cell[1:] != cell[:-1]]) if len(cell) else np.array([], dtype=int)
+    sums = np.zeros(minlength, dtype=np.float32)
+
+    if precision == 'pairwise':
+        for start, segment in zip(starts, np.split(weights, starts[1:])):
+            sums[cell[start]] = np.sum(segment, dtype=np.float32)
+    elif precision == 'kahan' and len(cell):
+        # The events of each cell are dealt over n_lanes lanes, each lane is summed
+        # with Kahan's method, and then the lanes of each cell are combined the same way.
+        counts = np.diff(np.r_[starts, len(cell)])
+        rank = np.arange(len(cell)) - np.repeat(starts, counts)
+        n_lanes = max(1, int(np.sqrt(counts.max())))
+        lane = np.repeat(np.arange(len(starts)), counts) * n_lanes + rank % n_lanes
+        lane_sums = kahan_sum(lane, rank // n_lanes, weights, len(starts) * n_lanes)
+        lanes = np.tile(np.arange(n_lanes), len(starts))
+        sums[cell[starts]] = kahan_sum(np.repeat(np.arange(len(starts)), n_lanes), lanes, lane_sums, len(starts))
+    elif precision != 'kahan':
+        raise ValueError(f'Precision {precision} not recognised. Only {precision_modes} are supported.')
+
+    return sums.astype(np.float64)
+
+
+def kahan_sum(index, step, values, size):
+    '''
+    float32 Kahan compensated sums of values into size accumulators. Each value
+    is added at its step, and no accumulator appears twice in the same step, so
+    every step is one vectorised update.
+    '''
+    sums = np.zeros(size, dtype=np.float32)
+    compensation = np.zeros(size, dtype=np.float32)
+    by_step = np.argsort(step, kind='stable')
+    step_starts = np.r_[0, np.cumsum(np.bincount(step))]
+    for k in range(len(step_starts) - 1):
+        events = by_step[step_starts[k]:step_starts[k+1]]
+        i = index[events]
+        y = values[events] - compensation[i]
+        t = sums[i] + y
+        compensation[i] = (t - sums[i]) - y
+        sums[i] = t
+
+    return sums
+
+
+def to_float32(df, columns=None):
+    '''
+    Returns a copy of df with float64 columns stored as float32, halving their memory.
+    Sums of the weights should then use a precision mode other than 'float32'.
+
+    Parameters:
+        df - pandas dataframe
+        columns - list of columns to convert, defaults to all float64 columns
+    '''
+    if columns is None:
+        columns = [c for c in df.columns if df[c].dtype == np.float64]
+    return df.astype({c: np.float32 for c in columns})
+
+
+def process_histograms(df, variable, bins=20, weight='post_fit_weight', precision=None):
+    '''
+    Weighted histograms of variable for each process in class_names_grouped, i.e.
+    the stacked histograms drawn by plot_variable, as arrays.
+
+    Parameters:
+        df - pandas dataframe
+        variable - string name of the variable to histogram
+        bins - number of bins or array of bin edges
+        weight - string name of the weight column
+        precision - accumulation mode, see weighted_bincount
 
-    # Reverse the counts before calculating.
-    # Zip up S, B, DS and DB per bin.
-    s_stack = counts_sb[0][::-1]   #counts height of signal in each bin from +1 to -1
-    b_stack = counts_sb[1][::-1]    #counts height of bkground in each bin from +1 to -1
+    Returns:
+        counts - numpy array of shape (len(class_names_grouped), n_bins)
+        bins - numpy array of bin edges
+    '''
+    values = df[variable].values
+    weights = df[weight].values
+    bins = np.histogram_bin_edges(values, bins=bins)
+    n_bins = len(bins) - 1
 
+    group = np.full(len(df), -1)
+    for i, t in enumerate(class_names_grouped):
+        group[df['sample'].isin(class_names_map[t]).values] = i
+    value_bin = bin_index(values, bins)
+    filled = (group >= 0) & (value_bin >= 0)
 
-    for s, b in zip(s_stack, b_stack): #iterates through every bin
-        this_sens = 2 * ((s + b) * math.log(1 + s / b) - s) #calcs sensivity for each bin
+    counts = weighted_bincount(group[filled] * n_bins + value_bin[filled], weights[filled],
+                               len(class_names_grouped) * n_bins, precision)
 
-        if not math.isnan(this_sens):   #unless bin empty add this_sense to sens_sq total (sums each bin sensitivity)
-            sens_sq += this_sens
+    return counts.reshape(len(class_names_grouped), n_bins), bins
 
 
-    # Sqrt operations and error equation balancing.
-    sens = math.sqrt(sens_sq)
+#mBB binning (MeV) used by the cut based sensitivity
+cut_based_bins = np.arange(20*1e3,260*1e3,20*1e3)
+
+
+def asimov_sensitivity(s_counts, b_counts):
+    '''
+    Combines the per-bin Asimov sensitivity 2*((s+b)*ln(1+s/b) - s) of a set of
+    histograms in quadrature. Empty bins (nan) are skipped, a bin with signal but
+    no background gives an infinite sensitivity, as in the original loop.
+
+    Parameters:
+        s_counts - array of signal counts, bins along the last axis
+        b_counts - array of background counts, same shape as s_counts
+
+    Returns:
+        sens - float, or numpy array over the leading axes if more than one
+            set of histograms is given
+    '''
+    return np.sqrt(asimov_terms(s_counts, b_counts).sum(axis=-1))
+
+
+def asimov_terms(s_counts, b_counts):
+    '''Per-bin terms of asimov_sensitivity, with empty bins set to 0'''
+    s_counts = np.asarray(s_counts, dtype=float)
+    b_counts = np.asarray(b_counts, dtype=float)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        this_sens = 2 * ((s_counts + b_counts) * np.log(1 + s_counts / b_counts) - s_counts)
+
+    return np.where(np.isnan(this_sens), 0, this_sens)
+
+
+def bin_index(values, bins):
+    '''
+    Returns the histogram bin of each value with np.histogram conventions (the
+    last bin includes its upper edge). Values outside the bins are given -1.
+    '''
+    values = np.asarray(values)
+    n_bins = len(bins) - 1
+    idx = np.searchsorted(bins, values, side='right') - 1
+    idx[values == bins[-1]] = n_bins - 1
+    idx[(idx < 0) | (idx >= n_bins)] = -1
+
+    return idx
+
+
+def threshold_slot(values, thresholds, direction='>'):
+    '''
+    Index of the slot between consecutive (sorted) thresholds each value falls
+    in, with slots ordered so that pass_counts can accumulate them.
+    '''
+    if direction == '>':
+        return np.searchsorted(thresholds, values, side='left')
+    elif direction == '<':
+        return np.searchsorted(thresholds, values, side='right')
+    else:
+        raise ValueError(f'Direction {direction} not recognised. Only > and < are supported.')
+
+
+def pass_counts(hist, axis=0, direction='>'):
+    '''
+    Turns a histogram over threshold slots (n_thr + 1 along axis) into the
+    sum passing each threshold (n_thr along axis).
+    '''
+    hist = np.moveaxis(hist, axis, 0)
+    if direction == '>':
+        #an event in slot k passes thresholds 0..k-1
+        counts = np.cumsum(hist[::-1], axis=0)[::-1][1:]
+    else:
+        #an event in slot k passes thresholds k..n_thr-1
+        counts = np.cumsum(hist, axis=0)[:-1]
+
+    return np.moveaxis(counts, 0, axis)
+
+
+def threshold_counts(values, mbb, classes, weights, thresholds, direction='>', bins=cut_based_bins, precision=None):
+    '''
+    Signal and background mBB histograms for every threshold of a one sided cut
+    on a variable, in a single pass over the events. Each event is assigned to
+    the slot between consecutive thresholds it falls in, and the histograms are
+    built as cumulative sums over those slots rather than re-filtering the
+    events for every threshold.
+
+    Parameters:
+        values - numpy array of the variable being cut on
+        mbb - numpy array of mBB values
+        classes - numpy array of class labels (1 signal, 0 background)
+        weights - numpy array of event weights
+        thresholds - sorted array of cut values
+        direction - '>' keeps events with values > threshold, '<' keeps
+            events with values < threshold
+        bins - mBB bin edges
+        precision - accumulation mode, see weighted_bincount
+
+    Returns:
+        s_counts, b_counts - numpy arrays of shape (len(thresholds), n_bins)
+    '''
+    thresholds = np.asarray(thresholds)
+    n_thr = len(thresholds)
+    n_bins = len(bins) - 1
+
+    slot = threshold_slot(values, thresholds, direction)
+    mbb_bin = bin_index(mbb, bins)
+    in_range = (mbb_bin >= 0) & ~np.isnan(values)
+    cell = slot[in_range] * n_bins + mbb_bin[in_range]
+    sig = classes[in_range] == 1
+
+    counts = []
+    for mask in (sig, ~sig):
+        hist = weighted_bincount(cell[mask], weights[in_range][mask], (n_thr + 1) * n_bins,
+                                 precision).reshape(n_thr + 1, n_bins)
+        counts.append(pass_counts(hist, 0, direction))
+
+    return counts[0], counts[1]
+
+
+def sensitivity_cut_based(df, precision=None):
+    """Calculate sensitivity from dataframe with error. precision is the accumulation mode of weighted_bincount"""
+
+    #Split into signal and background events and count them in each mBB bin
+    classes = df['Class'].values
+    mbb_bin = bin_index(df['mBB'].values, cut_based_bins)
+    weights = df['EventWeight'].values
+
+    in_range = mbb_bin >= 0
+    n_bins = len(cut_based_bins) - 1
+    sig = classes[in_range] == 1
+    s_counts = weighted_bincount(mbb_bin[in_range][sig], weights[in_range][sig], n_bins, precision)
+    b_counts = weighted_bincount(mbb_bin[in_range][~sig], weights[in_range][~sig], n_bins, precision)
+
+    return float(asimov_sensitivity(s_counts, b_counts))
+
+
+def sensitivity_cut_scan(df, variable, thresholds, direction='>', precision=None):
+    '''
+    Sensitivity after a cut on variable for each of the given thresholds, i.e.
+    the same as calling sensitivity_cut_based(df.loc[df[variable] > t]) for every
+    t, without copying the dataframe for each threshold.
+
+    Parameters:
+        df - pandas dataframe
+        variable - string name of the variable to cut on
+        thresholds - list/array of cut values
+        direction - '>' or '<', which side of the threshold to keep
+        precision - accumulation mode, see weighted_bincount
+
+    Returns:
+        sensitivities - numpy array, in the order of thresholds
+    '''
+    thresholds = np.asarray(thresholds, dtype=float)
+    order = np.argsort(thresholds, kind='stable')
+
+    s_counts, b_counts = threshold_counts(df[variable].values, df['mBB'].values, df['Class'].values,
+                                          df['EventWeight'].values, thresholds[order], direction,
+                                          precision=precision)
+
+    sensitivities = np.empty(len(thresholds))
+    sensitivities[order] = asimov_sensitivity(s_counts, b_counts)
+
+    return sensitivities
+
+
+def sensitivity_cut_scan_2d(df, variable_a, thresholds_a, variable_b, thresholds_b, directions=('>', '>'),
+                            max_cells=2**22, precision=None):
+    '''
+    Sensitivity for every pair of thresholds of cuts on two variables, i.e. the
+    same as sensitivity_cut_based(df.loc[(df[variable_a] > a) & (df[variable_b] > b)])
+    for every (a, b), without the nested loop over filtered copies.
+
+    Events are histogrammed once into a table of (slot_a, slot_b, mBB bin), which
+    is then summed cumulatively along both threshold axes (a 2D summed-area table)
+    to give the signal and background mBB histograms after every pair of cuts.
+    The table is built for a chunk of mBB bins at a time so that it holds at most
+    about max_cells entries.
 
-    return sens
+    Parameters:
+        df - pandas dataframe
+        variable_a, variable_b - string names of the variables to cut on
+        thresholds_a, thresholds_b - lists/arrays of cut values
+        directions - pair of '>' or '<', which side of each threshold to keep
+        max_cells - memory bound on the size of the table
+        precision - accumulation mode, see weighted_bincount
+
+    Returns:
+        sensitivities - numpy array of shape (len(thresholds_a), len(thresholds_b))
+    '''
+    thresholds_a = np.asarray(thresholds_a, dtype=float)
+    thresholds_b = np.asarray(thresholds_b, dtype=float)
+    order_a = np.argsort(thresholds_a, kind='stable')
+    order_b = np.argsort(thresholds_b, kind='stable')
+    n_a = len(thresholds_a) + 1
+    n_b = len(thresholds_b) + 1
+    n_bins = len(cut_based_bins) - 1
+
+    values_a = df[variable_a].values
+    values_b = df[variable_b].values
+    slot = (threshold_slot(values_a, thresholds_a[order_a], directions[0]) * n_b
+            + threshold_slot(values_b, thresholds_b[order_b], directions[1]))
+    mbb_bin = bin_index(df['mBB'].values, cut_based_bins)
+    in_range = (mbb_bin >= 0) & ~np.isnan(values_a) & ~np.isnan(values_b)
+    sig = df['Class'].values == 1
+    weights = df['EventWeight'].values
+
+    chunk = max(1, min(n_bins, max_cells // (n_a * n_b)))
+    sens_sq = np.zeros((n_a - 1, n_b - 1))
+    for start in range(0, n_bins, chunk):
+        n_chunk = min(chunk, n_bins - start)
+        in_chunk = in_range & (mbb_bin >= start) & (mbb_bin < start + n_chunk)
+        cell = slot * n_chunk + (mbb_bin - start)
+
+        counts = []
+        for mask in (in_chunk & sig, in_chunk & ~sig):
+            hist = weighted_bincount(cell[mask], weights[mask], n_a * n_b * n_chunk,
+                                     precision).reshape(n_a, n_b, n_chunk)
+            counts.append(pass_counts(pass_counts(hist, 0, directions[0]), 1, directions[1]))
+
+        sens_sq += asimov_terms(counts[0], counts[1]).sum(axis=-1)
+
+    sensitivities = np.empty_like(sens_sq)
+    sensitivities[np.ix_(order_a, order_b)] = np.sqrt(sens_sq)
+
+    return sensitivities
+
+
+def plot_sensitivity_heatmap(sensitivities, variable_a, thresholds_a, variable_b, thresholds_b):
+    '''
+    Plots the output of sensitivity_cut_scan_2d as a heatmap and marks the best
+    pair of thresholds. Infinite sensitivities (no background left) are not shown.
+
+    Parameters:
+        sensitivities - numpy array of shape (len(thresholds_a), len(thresholds_b))
+        variable_a, variable_b - string names of the variables, for the axis labels
+        thresholds_a, thresholds_b - lists/arrays of cut values
+
+    Returns:
+        fig, axes
+    '''
+    finite = np.where(np.isfinite(sensitivities), sensitivities, np.nan)
+    i, j = np.unravel_index(np.nanargmax(finite), finite.shape)
+    print(f"Maximum Sensitivity Value: {finite[i, j]}")
+    print(f"Corresponding {variable_a}, {variable_b} Thresholds: {thresholds_a[i]}, {thresholds_b[j]}")
+
+    fig = plt.figure(figsize=(10, 8))
+    axes = plt.gca()
+    mesh = axes.pcolormesh(thresholds_b, thresholds_a, finite, shading='nearest', cmap='viridis')
+    fig.colorbar(mesh, ax=axes, label='Sensitivity')
+    axes.plot(thresholds_b[j], thresholds_a[i], marker='x', color='red', markersize=12, mew=3)
+
+    axes.set_xlabel(f'{variable_b} Threshold', fontsize=14)
+    axes.set_ylabel(f'{variable_a} Threshold', fontsize=14)
+    axes.set_title(f'Sensitivity vs. {variable_a} and {variable_b} Thresholds', fontsize=16)
+    plt.tight_layout()
+    plt.show()
+
+    return fig, axes
+
+
+class IncrementalSelection:
+    '''
+    Cut based selection that keeps the per-process mBB histograms of the events
+    passing the current cuts, so that sensitivity and plots are updated without
+    going over the whole dataframe. When a cut is added, tightened or loosened,
+    only the events between the old and new threshold are looked at, found from
+    a sorted index of the variable, and their weights are added to or removed
+    from the histograms. Every change can be undone.
+
+    Parameters:
+        df - pandas dataframe, as used by sensitivity_cut_based and plot_variable
+        bins - mBB bin edges
+
+    Example:
+        selection = IncrementalSelection(df)
+        selection.cut('Mtop', '>', 225000)
+        selection.cut('pTB2', '>', 45000)
+        print(selection.sensitivity())
+        selection.undo()
+        selection.plot()
+    '''
 
+    def __init__(self, df, bins=cut_based_bins):
+        self.df = df
+        self.bins = bins
+        self.n_bins = len(bins) - 1
+        self.mbb_bin = bin_index(df['mBB'].values, bins)
+        self.signal = df['Class'].values == 1
+        self.event_weights = df['EventWeight'].values
+        self.post_fit_weights = df['post_fit_weight'].values
+        self.group = np.full(len(df), -1)
+        for i, t in enumerate(class_names_grouped):
+            self.group[df['sample'].isin(class_names_map[t]).values] = i
+
+        self.passing = np.ones(len(df), dtype=bool)
+        self.cuts = {}
+        self.history = []
+        self.index = {}
+
+        # Signal/background histograms for the sensitivity, per process histograms for plotting.
+        # The number of events in each bin is kept so that emptied bins are exactly 0
+        # rather than left with rounding errors from the subtractions.
+        self.sb_counts = np.zeros((2, self.n_bins))
+        self.sb_events = np.zeros((2, self.n_bins), dtype=int)
+        self.process_counts = np.zeros((len(class_names_grouped), self.n_bins))
+        self.process_events = np.zeros((len(class_names_grouped), self.n_bins), dtype=int)
+        self.update(np.arange(len(df)), 1)
+
+    def sorted_index(self, variable):
+        '''Sorted values of variable, the order of the events and the events with nan'''
+        if variable not in self.index:
+            values = self.df[variable].values
+            order = np.argsort(values, kind='stable')
+            self.index[variable] = (values[order], order, np.flatnonzero(np.isnan(values)))
+        return self.index[variable]
+
+    def update(self, events, sign):
+        '''Adds (sign 1) or removes (sign -1) events from the histograms'''
+        events = events[self.mbb_bin[events] >= 0]
+        mbb_bin = self.mbb_bin[events]
+
+        cell = np.where(self.signal[events], 0, self.n_bins) + mbb_bin
+        self.sb_counts += sign * np.bincount(cell, weights=self.event_weights[events],
+                                             minlength=2 * self.n_bins).reshape(2, self.n_bins)
+        self.sb_events += sign * np.bincount(cell, minlength=2 * self.n_bins).reshape(2, self.n_bins)
+        self.sb_counts[self.sb_events == 0] = 0
+
+        in_group = self.group[events] >= 0
+        cell = self.group[events][in_group] * self.n_bins + mbb_bin[in_group]
+        shape = self.process_counts.shape
+        self.process_counts += sign * np.bincount(cell, weights=self.post_fit_weights[events][in_group],
+                                                  minlength=self.process_counts.size).reshape(shape)
+        self.process_events += sign * np.bincount(cell, minlength=self.process_counts.size).reshape(shape)
+        self.process_counts[self.process_events == 0] = 0
+
+    def passes_cuts(self, events):
+        '''Whether each of the events passes all current cuts'''
+        mask = np.ones(len(events), dtype=bool)
+        for (variable, direction), threshold in self.cuts.items():
+            values = self.df[variable].values[events]
+            mask &= values > threshold if direction == '>' else values < threshold
+        return mask
+
+    def cut(self, variable, direction, threshold):
+        '''
+        Adds a cut keeping events with variable > threshold (direction '>') or
+        variable < threshold (direction '<'), or moves the threshold of an existing
+        cut on the same variable and direction.
+
+        Returns:
+            n_changed - number of events removed (or added back if the cut was loosened)
+        '''
+        if direction not in ('>', '<'):
+            raise ValueError(f'Direction {direction} not recognised. Only > and < are supported.')
+
+        key = (variable, direction)
+        previous = self.cuts.get(key)
+        no_cut = -np.inf if direction == '>' else np.inf
+        old = no_cut if previous is None else previous
+        new = no_cut if threshold is None else threshold
+
+        # Events whose value lies between the old and new threshold
+        sorted_values, order, nan_events = self.sorted_index(variable)
+        side = 'right' if direction == '>' else 'left'
+        lo = np.searchsorted(sorted_values, min(old, new), side=side)
+        hi = np.searchsorted(sorted_values, max(old, new), side=side)
+        candidates = order[lo:hi]
+        if previous is None or threshold is None:
+            candidates = np.concatenate([candidates, nan_events])
+
+        if threshold is None:
+            del self.cuts[key]
+        else:
+            self.cuts[key] = threshold
+
+        tightened = new > old if direction == '>' else new < old
+        if tightened:
+            changed = candidates[self.passing[candidates]]
+            self.passing[changed] = False
+            self.update(changed, -1)
+        else:
+            candidates = candidates[~self.passing[candidates]]
+            changed = candidates[self.passes_cuts(candidates)]
+            self.passing[changed] = True
+            self.update(changed, 1)
+
+        self.history.append((key, previous, changed, tightened))
+        return len(changed)
+
+    def remove_cut(self, variable, direction):
+        '''Removes the cut on variable in the given direction'''
+        if (variable, direction) not in self.cuts:
+            raise ValueError(f'No cut {variable} {direction} to remove. Current cuts are {list(self.cuts)}.')
+        return self.cut(variable, direction, None)
+
+    def undo(self):
+        '''Reverts the last change of cuts'''
+        if not self.history:
+            raise ValueError('No change of cuts to undo.')
+        key, previous, changed, tightened = self.history.pop()
+        if previous is None:
+            self.cuts.pop(key, None)
+        else:
+            self.cuts[key] = previous
+
+        self.passing[changed] = tightened
+        self.update(changed, 1 if tightened else -1)
+
+    def sensitivity(self):
+        '''Same as sensitivity_cut_based on the events passing the cuts'''
+        return float(asimov_sensitivity(self.sb_counts[0], self.sb_counts[1]))
+
+    def dataframe(self):
+        '''The events passing the cuts, e.g. for plot_variable of other variables'''
+        return self.df.loc[self.passing]
+
+    def plot(self):
+        '''Plots the stacked mBB distribution of the events passing the cuts, as plot_variable'''
+        plt.ion()
+        plt.close("all")
+        fig = plt.figure(figsize=(8.5*1.2,7*1.2))
+        bins = self.bins / 1e3
+        centres = (bins[1:] + bins[:-1]) / 2
+        multiplier = 20
+
+        plt.hist([centres] * len(class_names_grouped),
+                 bins=bins,
+                 weights=list(self.process_counts[::-1]),
+                 rwidth=1,
+                 color=[colour_map[t] for t in class_names_grouped[::-1]],
+                 label=legend_names[::-1],
+                 stacked=True,
+                 edgecolor='none')
+        plt.hist(centres,
+                 bins=bins,
+                 weights=self.process_counts[0] * multiplier,
+                 rwidth=1,
+                 histtype='step',
+                 linewidth=2,
+                 color='#FF0000',
+                 edgecolor='#FF0000')
+        plt.plot([],[],color='#FF0000',label=r'VH $\rightarrow$ Vbb x '+str(multiplier))
+
+        axes = plt.gca()
+        plt.xticks(fontweight = 'normal',fontsize = 20)
+        plt.yticks(fontweight = 'normal',fontsize = 20)
+        axes.yaxis.set_ticks_position('both')
+        axes.yaxis.set_tick_params(which='major', direction='in', length=10, width=1)
+        axes.xaxis.set_ticks_position('both')
+        axes.xaxis.set_tick_params(which='major', direction='in', length=10, width=1)
+        axes.xaxis.set_minor_locator(AutoMinorLocator(4))
+
+        handles, labels = axes.get_legend_handles_labels()
+        handles = handles[::-1]
+        handles = handles+handles
+        handles = handles[1:12]
+        plt.legend(loc='upper right', ncol=1, prop={'size': 12},frameon=False,
+                   handles=handles)
+
+        plt.ylabel("Events",fontsize = 20,fontweight='normal')
+        axes.yaxis.set_label_coords(-0.07,0.93)
+        plt.xlabel(r"$m_{bb}$ GeV",fontsize = 20,fontweight='normal')
+        axes.xaxis.set_label_coords(0.89, -0.07)
+        plt.show()
+
+        return fig, axes
 
 
 # def sensitivity_bdt(df):
@@ -656,8 +1212,10 @@ def plot_histories(histories):
 
     if not isinstance(histories, list):
         histories = [histories]
-    
-    fig, ax = plt.subplots(1,2,figsize=(15,5))
+
+    # Add a panel for the validation sensitivity if a masterclass_callbacks.SensitivityCallback was used
+    plot_sens = any('val_sensitivity' in hist.history for hist in histories)
+    fig, ax = plt.subplots(1,3 if plot_sens else 2,figsize=(22.5 if plot_sens else 15,5))
     main_lines = []
     main_labels = []
     for i, hist in enumerate(histories):
@@ -680,6 +1238,12 @@ def plot_histories(histories):
         ax[1].set_xlabel("Epoch")
         # ax[1].legend()
 
+        if plot_sens and 'val_sensitivity' in hist.history:
+            ax[2].plot(hist.history['val_sensitivity'], ls='dotted', c=col, )
+            ax[2].set_title("Sensitivity")
+            ax[2].set_ylabel("Validation Sensitivity")
+            ax[2].set_xlabel("Epoch")
+
     custom_lines = [Line2D([0], [0], color='black', lw=2, ls='solid'),
                 Line2D([0], [0], color='black', lw=2, ls='dotted'),
                 ]
@@ -694,143 +1258,261 @@ def plot_histories(histories):
     plt.show()
 
 
-def sensitivity_NN(df):
-    """Calculate sensitivity from dataframe with error"""
+def sensitivity_NN(df, precision=None):
+    """Calculate sensitivity from dataframe with error. precision is the accumulation mode of weighted_bincount"""
 
-    bins, bin_sums_w2_s, bin_sums_w2_b = trafoD_with_error(df, 1000)
+    return sensitivity_NN_arrays(df['decision_value'].values, df['Class'].values,
+                                 df['EventWeight'].values, df['post_fit_weight'].values, precision)
 
-    # Initialise sensitivity and error.
-    sens_sq = 0
-    error_sq = 0
 
-    #Split into signal and background events
-    classes = df['Class']
-    dec_vals = df['decision_value']
-    weights = df['EventWeight']
-
-    y_data = zip(classes, dec_vals, weights)
-
-    events_sb = [[a[1] for a in deepcopy(y_data) if a[0] == 1], [a[1] for a in deepcopy(y_data) if a[0] == 0]]
-    weights_sb = [[a[2] for a in deepcopy(y_data) if a[0] == 1], [a[2] for a in deepcopy(y_data) if a[0] == 0]]
-
-    #plots histogram with optimised bins and counts number of signal and background events in each bin
-    plt.ioff()
-    counts_sb = plt.hist(events_sb,
-                         bins=bins,
-                         weights=weights_sb)[0]
-    plt.close()
-    plt.ion()
+def sensitivity_NN_arrays(decision_value, classes, event_weights, post_fit_weights, precision=None):
+    '''
+    Array version of sensitivity_NN, for use where the dataframe is not needed
+    (e.g. every epoch during training). TrafoD binning is built from
+    post_fit_weights and the sensitivity from event_weights, as in sensitivity_NN.
+    precision is the accumulation mode of weighted_bincount.
 
-    # Reverse the counts before calculating.
-    # Zip up S, B, DS and DB per bin.
-    s_stack = counts_sb[0][::-1]   #counts height of signal in each bin from +1 to -1
-    b_stack = counts_sb[1][::-1]    #counts height of bkground in each bin from +1 to -1
-    ds_sq_stack = bin_sums_w2_s[::-1]
-    db_sq_stack = bin_sums_w2_b[::-1]
-
-    for s, b, ds_sq, db_sq in zip(s_stack, b_stack, ds_sq_stack, db_sq_stack): #iterates through every bin
-        if b != 0:
-            this_sens = 2 * ((s + b) * math.log(1 + s / b) - s) #calcs sensivity for each bin
-            this_dsens_ds = 2 * math.log(1 + s/b)
-            this_dsens_db = 2 * (math.log(1 + s/b) - s/b)
-            this_error = (this_dsens_ds ** 2) * ds_sq + (this_dsens_db ** 2) * db_sq
-            if not math.isnan(this_sens):   #unless bin empty add this_sense to sens_sq total (sums each bin sensitivity)
-                sens_sq += this_sens
-            if not math.isnan(this_error):  #unless bin empty add this_error to error_sq total
-                error_sq += this_error
+    Returns:
+        sens, error - floats
+    '''
+    bins, bin_sums_w2_s, bin_sums_w2_b = trafoD_arrays(decision_value, classes, post_fit_weights, 1000,
+                                                       precision=precision)
+
+    #counts number of signal and background events in each of the optimised bins
+    dv_bin = bin_index(decision_value, bins)
+    in_range = dv_bin >= 0
+    sig = classes[in_range] == 1
+    s = weighted_bincount(dv_bin[in_range][sig], event_weights[in_range][sig], len(bins) - 1, precision)
+    b = weighted_bincount(dv_bin[in_range][~sig], event_weights[in_range][~sig], len(bins) - 1, precision)
+
+    #per bin sensitivity and its error, skipping bins without background
+    filled = b != 0
+    s, b = s[filled], b[filled]
+    ds_sq, db_sq = bin_sums_w2_s[filled], bin_sums_w2_b[filled]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        log_term = np.log(1 + s / b)
+        this_sens = 2 * ((s + b) * log_term - s)
+        this_dsens_ds = 2 * log_term
+        this_dsens_db = 2 * (log_term - s / b)
+        this_error = (this_dsens_ds ** 2) * ds_sq + (this_dsens_db ** 2) * db_sq
+
+    sens_sq = float(this_sens[~np.isnan(this_sens)].sum())
+    error_sq = float(this_error[~np.isnan(this_error)].sum())
 
     # Sqrt operations and error equation balancing.
     sens = math.sqrt(sens_sq)
-    error = 0.5 * math.sqrt(error_sq/sens_sq)
+    error = 0.5 * math.sqrt(error_sq/sens_sq) if sens_sq else math.nan
 
     return sens, error
 
 
-def trafoD_with_error(df, initial_bins=1000, z_s=10, z_b=10): #total number of bins = z_s + z_b
+def trafoD_with_error(df, initial_bins=1000, z_s=10, z_b=10, precision=None): #total number of bins = z_s + z_b
     """Output optimised histogram bin widths from a list of events"""
 
-    df = df.sort_values(by='decision_value')
+    bins, delta_bins_s, delta_bins_b = trafoD_arrays(df['decision_value'].values, df['Class'].values,
+                                                     df['post_fit_weight'].values, initial_bins, z_s, z_b, precision)
+
+    return bins.tolist(), delta_bins_s.tolist(), delta_bins_b.tolist()
+
+
+def trafoD_arrays(decision_value, classes, post_fit_weights, initial_bins=1000, z_s=10, z_b=10, precision=None):
+    '''
+    TrafoD binning on numpy arrays. Rather than popping events one at a time,
+    the events are histogrammed once on the scan points and the bins are
+    merged with a loop over the initial_bins scan points only.
+
+    Parameters:
+        decision_value - numpy array of classifier outputs
+        classes - numpy array of class labels (1 signal, 0 background)
+        post_fit_weights - numpy array of event weights
+        initial_bins - number of scan points in [-1, 1]
+        z_s, z_b - total number of bins is z_s + z_b
+        precision - accumulation mode, see weighted_bincount
 
-    N_s = sum(df['post_fit_weight']*df['Class'])
-    N_b = sum(df['post_fit_weight']*(1-df['Class']))
+    Returns:
+        bins - numpy array of bin edges
+        delta_bins_s, delta_bins_b - numpy arrays of the sum of signal and
+            background weights squared in each bin
+    '''
+    N_b, N_s = weighted_bincount((classes == 1).astype(int), post_fit_weights, 2, precision)
 
+    # Scan points in descending order
+    scan_points = np.linspace(-1, 1, num=initial_bins)[1:-1][::-1]
+    n_scan = len(scan_points)
 
-    # Set up scan parameters.
-    scan_points = np.linspace(-1, 1, num=initial_bins).tolist()[1:-1]
-    scan_points = scan_points[::-1] #invert list
+    # Index of the scan point each event is counted at, i.e. the first (highest)
+    # scan point it is above. Events below the last scan point are never counted.
+    scan_idx = n_scan - np.searchsorted(scan_points[::-1], decision_value, side='right')
+    counted = scan_idx < n_scan
+    scan_idx = scan_idx[counted]
+    sig = classes[counted] == 1
+    w = post_fit_weights[counted]
 
-    # Initialise z and bin list.
+    sig_bin = weighted_bincount(scan_idx[sig], w[sig], n_scan, precision)
+    back_bin = weighted_bincount(scan_idx[~sig], w[~sig], n_scan, precision)
+    w2_s = weighted_bincount(scan_idx[sig], w[sig], n_scan, precision, power=2)
+    w2_b = weighted_bincount(scan_idx[~sig], w[~sig], n_scan, precision, power=2)
+
+    # Scan stops at the point where the last event is counted
+    last = scan_idx.max() if len(scan_idx) else 0
+    all_counted = counted.all()
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        dz = (z_s * sig_bin[:last+1] / N_s + z_b * back_bin[:last+1] / N_b).tolist()
+
+    # Merge scan bins until each holds z > 1
     z = 0
     bins = [1.0]
     sum_w2_s = 0
     sum_w2_b = 0
-    delta_bins_s = list()
-    delta_bins_b = list()
-
-    decision_values_list = df['decision_value'].tolist()
-    class_values_list = df['Class'].tolist()
-    post_fit_weights_values_list = df['post_fit_weight'].tolist()
-
-    try:
-        # Iterate over bin low edges in scan.
-        for p in scan_points:
-            # Initialise freq count for this bin
-            sig_bin = 0
-            back_bin = 0
-
-            # Current bin loop.
-            # Remember, events are in descending DV order.
-            while True:
-                """ This loop sums the post_fit_weight and p.f.w squared of signal and of background events contained in each of the initial bins"""
-                # End algo if no events left - update z and then IndexError
-
-                if not decision_values_list: #if not empty (NEVER CALLS THIS CODE)
-                    z += z_s * sig_bin / N_s + z_b * back_bin / N_b
-                    if z > 1:
-                        bins.insert(0, p)
-                        delta_bins_s.insert(0, sum_w2_s)
-                        delta_bins_b.insert(0, sum_w2_b)
-                    raise IndexError
-
-
-                # Break if DV not in bin. (i.e when finished scanning over each of the inital bins)
-                if decision_values_list[-1] < p:  #negative index counts from the right (i.e last object)
-                    break
-
-                # Pop the event.
-                decison_val = decision_values_list.pop()
-                class_val = class_values_list.pop()
-                post_fit_weight_val = post_fit_weights_values_list.pop()
-
-                # Add freq to S/B count, and the square to sums of w2.
-                if class_val == 1:
-                    sig_bin += post_fit_weight_val
-                    sum_w2_s += post_fit_weight_val ** 2
-                else:
-                    back_bin += post_fit_weight_val
-                    sum_w2_b += post_fit_weight_val ** 2
-
-            # Update z for current bin.
-            z += z_s * sig_bin / N_s + z_b * back_bin / N_b   #10*(% of total signal + # of total background)
-
-            # Reset z and update bin
-            if z > 1:
-                bins.insert(0, p)
-                z = 0
-
-                # Update sum_w2 for this bin.
-                delta_bins_s.insert(0, sum_w2_s)
-                delta_bins_b.insert(0, sum_w2_b)
-                sum_w2_s = 0 #not sure why this is at the end and sig_bin/back_bin reset at the beginning
-                sum_w2_b = 0
-
-    except IndexError:
-        rewje = 0
-
-    finally:
-        bins.insert(0,-1.0)
-        delta_bins_s.insert(0, sum_w2_s)  #sum of signal event weights^2 for each bin
-        delta_bins_b.insert(0, sum_w2_b)  #sum of background event weights^2 for each bin
-        # print("TrafoD",len(bins))
-        return bins, delta_bins_s, delta_bins_b
+    delta_bins_s = []
+    delta_bins_b = []
+    for j in range(last + 1):
+        sum_w2_s += w2_s[j]
+        sum_w2_b += w2_b[j]
+        z += dz[j]
+        if z > 1:
+            bins.append(scan_points[j])
+            delta_bins_s.append(sum_w2_s)
+            delta_bins_b.append(sum_w2_b)
+            if j == last and all_counted:
+                # the original algorithm repeats the last sums when it runs out of events
+                break
+            z = 0
+            sum_w2_s = 0
+            sum_w2_b = 0
+
+    bins.append(-1.0)
+    delta_bins_s.append(sum_w2_s)
+    delta_bins_b.append(sum_w2_b)
+
+    return np.array(bins[::-1]), np.array(delta_bins_s[::-1]), np.array(delta_bins_b[::-1])
+
+
+def precision_report(df, precisions=None, float32_storage=True):
+    '''
+    Compares the sensitivities computed with each accumulation mode against the
+    float64 reference, to check that a float32 path is safe for a dataset.
+
+    Parameters:
+        df - pandas dataframe. sensitivity_NN is included if it has 'decision_value'
+        precisions - list of modes to compare, defaults to all precision_modes
+        float32_storage - convert the float64 columns of df to float32 for the
+            modes being compared, as they would be stored in production
+
+    Returns:
+        report - pandas dataframe with one row per mode and quantity, giving the
+            value, the float64 reference and their relative difference
+    '''
+    quantities = {'sensitivity_cut_based': lambda d, p: sensitivity_cut_based(d, p)}
+    if 'decision_value' in df.columns:
+        quantities['sensitivity_NN'] = lambda d, p: sensitivity_NN(d, p)[0]
+        quantities['sensitivity_NN error'] = lambda d, p: sensitivity_NN(d, p)[1]
+
+    df_test = to_float32(df) if float32_storage else df
+    reference = {name: f(df, 'float64') for name, f in quantities.items()}
+
+    rows = []
+    for precision in precisions or precision_modes:
+        for name, f in quantities.items():
+            value = f(df_test, precision)
+            rows.append({'precision': precision, 'quantity': name, 'value': value,
+                         'reference': reference[name],
+                         'relative_difference': abs(value - reference[name]) / abs(reference[name])})
+
+    return pd.DataFrame(rows)
+
+
+def train_fold(build_model, df_train, df_test, variables, scaler='standard', fit_kwargs=None, seed=None,
+               return_model=False):
+    '''
+    Trains one fold of kfold_sensitivity and returns the decision values of the
+    held out events. Scaling is fitted on the training folds only.
+
+    Parameters:
+        build_model - function taking no arguments and returning a compiled model
+        df_train - pandas dataframe of training events
+        df_test - pandas dataframe of held out events
+        variables - list of strings of variables to be used for training
+        scaler - scaling mode passed to scale_prepare_data
+        fit_kwargs - dict of keyword arguments for model.fit
+        seed - integer random seed, or None
+        return_model - also return the trained model
+
+    Returns:
+        decision_value - 1D numpy array, one entry per event in df_test
+        model - the trained model, only if return_model is True
+    '''
+    if seed is not None:
+        np.random.seed(seed)
+        try:
+            import keras
+            keras.utils.set_random_seed(seed)
+        except (ImportError, AttributeError):
+            pass
+
+    x_train, y_train, w_train, _, (x_test, _) = scale_prepare_data(df_train, df_test, df_test, variables, scaler)
+
+    model = build_model()
+    model.fit(x_train, y_train, sample_weight=w_train, **(fit_kwargs or {}))
+
+    decision_value = np.asarray(model.predict(x_test, verbose=0)).reshape(-1)
+
+    if return_model:
+        return decision_value, model
+    return decision_value
+
+
+def kfold_sensitivity(df, build_model, variables, k=5, scaler='standard', fit_kwargs=None, n_jobs=None, seed=0):
+    '''
+    k-fold cross validated sensitivity. The events are split into k folds (keeping
+    the signal fraction of each fold the same), a model is trained on k-1 folds
+    and scores the remaining one, so every event gets an out-of-fold decision
+    value and sensitivity_NN can use the full sample. Folds are trained in
+    parallel worker processes.
+
+    The workers are fresh processes started by joblib's loky backend rather
+    than forks of the notebook kernel, as TensorFlow is not fork safe once it is
+    running. Functions defined in the notebook, such as model_nodes_1, are sent
+    to them with cloudpickle, e.g. build_model=partial(model_nodes_1, 120, variables).
+
+    Parameters:
+        df - pandas dataframe with the training variables, 'Class', 'training_weight',
+            'EventWeight' and 'post_fit_weight'
+        build_model - function taking no arguments and returning a compiled model
+        variables - list of strings of variables to be used for training
+        k - number of folds
+        scaler - scaling mode passed to scale_prepare_data
+        fit_kwargs - dict of keyword arguments for model.fit, e.g. {'epochs': 4, 'batch_size': 64}
+        n_jobs - number of worker processes, defaults to k. 1 trains in the current process
+        seed - integer seed for the fold split and the training of each fold
+
+    Returns:
+        (sens, error) - sensitivity_NN of the full sample with out-of-fold decision values
+        fold_sensitivities - numpy array of the sensitivity of each held out fold,
+            with weights scaled by k so each one estimates the full sample
+            sensitivity. Their spread gives the uncertainty from the training.
+        decision_value - numpy array of out-of-fold decision values, in the order of df
+    '''
+    columns = list(variables) + ['Class', 'training_weight']
+    folds = list(StratifiedKFold(n_splits=k, shuffle=True, random_state=seed).split(df, df['Class']))
+    jobs = [(build_model, df.iloc[train_idx][columns], df.iloc[test_idx][columns], variables, scaler,
+             fit_kwargs, None if seed is None else seed + i) for i, (train_idx, test_idx) in enumerate(folds)]
+
+    scores = Parallel(n_jobs=n_jobs or k, backend='loky')(delayed(train_fold)(*job) for job in jobs)
+
+    # Assemble the out-of-fold scores into one array
+    decision_value = np.empty(len(df))
+    for (_, test_idx), score in zip(folds, scores):
+        decision_value[test_idx] = score
+
+    df_scored = df[['Class', 'EventWeight', 'post_fit_weight']].copy()
+    df_scored['decision_value'] = decision_value
+
+    fold_sensitivities = []
+    for _, test_idx in folds:
+        df_fold = df_scored.iloc[test_idx].copy()
+        df_fold[['EventWeight', 'post_fit_weight']] *= k
+        fold_sensitivities.append(sensitivity_NN(df_fold)[0])
 
+    return sensitivity_NN(df_scored), np.array(fold_sensitivities), decision_value